@@ -1,5 +1,6 @@
 """Define self-attention decoder."""
 import sys
+import math
 sys.path.append("/gpfsdswork/projects/rech/sfz/utt84zy/anaconda3/envs/huggingface/lib/python3.7/site-packages")
 import numpy as np
 import tensorflow as tf
@@ -15,6 +16,43 @@ from opennmt import constants
 from opennmt.inputters import text_inputter
 from opennmt.utils.misc import shape_list
 
+def _sinusoidal_position_encoding(positions, depth):
+  """Returns the encodings of the 1-D tensor :obj:`positions` computed as in
+  :class:`opennmt.layers.SinusoidalPositionEncoder`.
+  """
+  positions = tf.cast(positions, tf.float32)
+  log_timescale_increment = math.log(10000) / (depth / 2 - 1)
+  inv_timescales = tf.exp(tf.range(depth // 2, dtype=tf.float32) * -log_timescale_increment)
+  scaled_time = tf.expand_dims(positions, 1) * tf.expand_dims(inv_timescales, 0)
+  return tf.concat([tf.sin(scaled_time), tf.cos(scaled_time)], axis=1)
+
+def _as_tuple(x):
+  """Returns the memory (or memory lengths) as a tuple with one entry per source."""
+  if x is None or isinstance(x, tuple):
+    return x
+  if isinstance(x, list):
+    return tuple(x)
+  return (x,)
+
+def _slice_or_compute(length, limit, sliced_fn, computed_fn):
+  """Returns ``sliced_fn()``, which slices a cached tensor, when :obj:`length` is
+  at most :obj:`limit`, and ``computed_fn()`` otherwise.
+  """
+  static_length = tf.get_static_value(length)
+  if static_length is not None:
+    return sliced_fn() if static_length <= limit else computed_fn()
+  return tf.cond(tf.less_equal(length, limit), sliced_fn, computed_fn)
+
+def _next_power_of_two(n):
+  return 2**int(math.ceil(math.log2(max(n, 1))))
+
+def _call_layer(layer, inputs, **kwargs):
+  return layer(inputs, **kwargs)
+
+def _call_adapter(layer, inputs, domain, residual):
+  # The residual connection is fused with the adapter (see Multi_domain_FeedForwardNetwork).
+  return layer(inputs, domain, residual=residual)
+
 class Multi_domain_SelfAttentionDecoder(Decoder):
   
   def __init__(self,
@@ -31,31 +69,72 @@ class Multi_domain_SelfAttentionDecoder(Decoder):
                ffn_activation=tf.nn.relu,
                position_encoder_class=SinusoidalPositionEncoder,
                num_sources=1,
+               maximum_length=1024,
+               maximum_memory_length=1024,
+               mixed_precision=None,
+               maximum_decoding_length=None,
+               quantize_cache=False,
+               jit_compile=False,
                **kwargs):
     
     super(Multi_domain_SelfAttentionDecoder, self).__init__(num_sources=num_sources, **kwargs)
     self.num_units = num_units
     self.num_heads = num_heads
     self.dropout = dropout
+    self.maximum_length = maximum_length
+    # Causal mask sliced for each batch. Longer targets compute their own.
+    self._causal_mask = tf.linalg.band_part(tf.ones([maximum_length, maximum_length], dtype=tf.bool), -1, 0)
+    # Positions compared against the target and memory lengths to build their masks.
+    # Longer sources fall back to tf.sequence_mask.
+    self.maximum_memory_length = maximum_memory_length
+    self._arange = tf.range(max(maximum_length, maximum_memory_length))
+    # When set, the self-attention cache is preallocated to this length (rounded up
+    # to a power of two) and updated in place during decoding. dynamic_decode grows
+    # it to the maximum number of decoding iterations when needed.
+    self.cache_length = None
+    if maximum_decoding_length is not None:
+      self.cache_length = _next_power_of_two(maximum_decoding_length)
+    # When set, the self-attention keys and values are cached in int8 with a
+    # float16 scale per timestep and head.
+    self.quantize_cache = quantize_cache
+    # When set, the embedding preparation and the adapters run as XLA clusters. They
+    # are compiled again for each new input shape.
+    self.jit_compile = jit_compile
     self.position_encoder = None
     if position_encoder_class is not None:
       self.position_encoder = position_encoder_class()
-    self.layer_norm = common.LayerNorm()
-    self.layers = [
-        transformer.SelfAttentionDecoderLayer(
-            self.num_units,
-            self.num_heads,
-            ffn_inner_dim,
-            num_sources=num_sources,
-            dropout=dropout,
-            attention_dropout=attention_dropout,
-            ffn_dropout=ffn_dropout,
-            ffn_activation=ffn_activation)
-        for i in range(num_layers)]
-    self.mask = make_domain_mask(num_domains, num_units, num_domain_units=num_domain_units)
-    self.multi_domain_layers = [
-        Multi_domain_FeedForwardNetwork(num_domains*num_domain_units, num_units, name="ADAP_%d"%i)
-        for i in range(num_layers)]
+    # Sinusoidal encodings do not depend on the inputs and are computed once, up to
+    # maximum_length. Later positions are encoded on the fly.
+    self._position_table = None
+    if position_encoder_class is SinusoidalPositionEncoder:
+      with tf.init_scope():
+        self._position_table = _sinusoidal_position_encoding(tf.range(maximum_length + 1), num_units)
+    # The final normalization feeds the output layer and always runs in float32.
+    self.layer_norm = common.LayerNorm(dtype="float32")
+    # The decoder layers and adapters are built under the optional mixed precision
+    # policy (e.g. "mixed_bfloat16").
+    global_policy = tf.keras.mixed_precision.global_policy()
+    policy = tf.keras.mixed_precision.Policy(mixed_precision) if mixed_precision else global_policy
+    self._body_dtype = policy.compute_dtype
+    tf.keras.mixed_precision.set_global_policy(policy)
+    try:
+      self.layers = [
+          transformer.SelfAttentionDecoderLayer(
+              self.num_units,
+              self.num_heads,
+              ffn_inner_dim,
+              num_sources=num_sources,
+              dropout=dropout,
+              attention_dropout=attention_dropout,
+              ffn_dropout=ffn_dropout,
+              ffn_activation=ffn_activation)
+          for i in range(num_layers)]
+      self.multi_domain_layers = [
+          Multi_domain_FeedForwardNetwork(num_domains*num_domain_units, num_units, num_domains=num_domains, jit_compile=jit_compile, name="ADAP_%d"%i)
+          for i in range(num_layers)]
+    finally:
+      # The global policy is shared by every model built in the process.
+      tf.keras.mixed_precision.set_global_policy(global_policy)
     self.ADAP_layer_stopping_gradient=ADAP_layer_stopping_gradient
   def initialize(self, vocab_size=None, output_layer=None):
     
@@ -86,62 +165,173 @@ class Multi_domain_SelfAttentionDecoder(Decoder):
       m += layer.map_v1_weights(weights["layer_%d" % i])
     return m
 
+  def _embed_prep(self, inputs, position=None, training=None):
+    """Scales the embeddings, adds the position encodings and applies dropout."""
+    inputs *= self.num_units**0.5
+    if self._position_table is not None:
+      if position is None:
+        last_position = tf.shape(inputs)[1]
+        positions = tf.range(1, last_position + 1)
+        table_encoding = lambda: self._position_table[1:last_position + 1]
+      else:
+        last_position = position
+        positions = tf.reshape(position, [1])
+        table_encoding = lambda: tf.gather(self._position_table, positions)
+      encoding = _slice_or_compute(
+          last_position,
+          self.maximum_length,
+          table_encoding,
+          lambda: _sinusoidal_position_encoding(positions, self.num_units))
+      inputs += tf.cast(encoding, inputs.dtype)
+    elif self.position_encoder is not None:
+      inputs = self.position_encoder(inputs, position=position)
+    inputs = tf.cast(inputs, self._body_dtype)
+    return common.dropout(inputs, self.dropout, training=training)
+
+  # Same as _embed_prep as a single XLA cluster, used when jit_compile is set.
+  _jit_embed_prep = tf.function(_embed_prep, jit_compile=True, experimental_relax_shapes=True)
+
+  def _future_mask(self, maximum_length, sequence_length=None):
+    """Returns the causal mask, sliced from the cached one when
+    :obj:`maximum_length` fits in it.
+    """
+    mask = _slice_or_compute(
+        maximum_length,
+        self.maximum_length,
+        lambda: self._causal_mask[:maximum_length, :maximum_length],
+        lambda: tf.linalg.band_part(tf.ones([maximum_length, maximum_length], dtype=tf.bool), -1, 0))
+    mask = tf.expand_dims(mask, 0)
+    if sequence_length is not None:
+      sequence_mask = self._sequence_mask(sequence_length, maximum_length)
+      mask = tf.math.logical_and(mask, tf.expand_dims(sequence_mask, 1))
+    return mask
+
+  def _sequence_mask(self, lengths, maxlen):
+    """Same as :obj:`tf.sequence_mask` but slices the cached :obj:`_arange` when
+    :obj:`maxlen` fits in it.
+    """
+    return _slice_or_compute(
+        maxlen,
+        self._arange.shape[0],
+        lambda: tf.expand_dims(self._arange[:maxlen], 0) < tf.expand_dims(tf.cast(lengths, tf.int32), 1),
+        lambda: tf.sequence_mask(lengths, maxlen=maxlen))
+
   def _run(self,
            inputs,
            sequence_length=None,
-           cache=None,
            memory=None,
            memory_sequence_length=None,
-           step=None,
            training=None):
+    return self._run_core(
+        inputs,
+        _call_layer,
+        _call_adapter,
+        self.layer_norm,
+        sequence_length=sequence_length,
+        memory=memory,
+        memory_sequence_length=memory_sequence_length,
+        training=training)
+
+  def _run_core(self,
+                inputs,
+                layer_fn,
+                adapter_fn,
+                layer_norm_fn,
+                sequence_length=None,
+                memory=None,
+                memory_sequence_length=None,
+                training=None):
+    """Shared implementation of :meth:`_run` and :meth:`_run_forward_fn` on full
+    target sequences. Decoding steps go through :meth:`_run_step`.
+
+    :obj:`layer_fn`, :obj:`adapter_fn` and :obj:`layer_norm_fn` run the
+    decoder layers, the domain adapters and the final normalization (see
+    :func:`_call_layer` and :func:`_call_adapter`).
+    """
     # Process inputs.
     domain = inputs[1]
-    domain_mask = tf.nn.embedding_lookup(self.mask, domain)
-    inputs = inputs[0]
-    inputs *= self.num_units**0.5
-    if self.position_encoder is not None:
-      inputs = self.position_encoder(inputs, position=step + 1 if step is not None else None)
-    inputs = common.dropout(inputs, self.dropout, training=training)
+    embed_prep = self._jit_embed_prep if self.jit_compile else self._embed_prep
+    inputs = embed_prep(inputs[0], training=training)
 
     # Prepare query mask.
-    mask = None
-    if step is None:
-      maximum_length = tf.shape(inputs)[1]
-      if sequence_length is None:
-        batch_size = tf.shape(inputs)[0]
-        sequence_length = tf.fill([batch_size], maximum_length)
-      mask = transformer.future_mask(sequence_length, maximum_length=maximum_length)
+    mask = self._future_mask(shape_list(inputs)[1], sequence_length=sequence_length)
 
     # Prepare memory mask.
-    memory_mask = None
-    if memory is not None:
-      if not isinstance(memory, (list, tuple)):
-        memory = (memory,)
-    if memory_sequence_length is not None:
-      if not isinstance(memory_sequence_length, (list, tuple)):
-        memory_sequence_length = (memory_sequence_length,)
-      memory_mask = [
-          tf.sequence_mask(mem_length, maxlen=tf.shape(mem)[1])
-          for mem, mem_length in zip(memory, memory_sequence_length)]
+    memory_mask = self._memory_mask(memory, memory_sequence_length)
 
-    # Run each layer.
-    new_cache = []
-    for i, (layer, multi_domain_layer) in enumerate(zip(self.layers,self.multi_domain_layers)):
+    inputs, new_cache, attention = self._run_layers(
+        inputs,
+        domain,
+        layer_fn,
+        adapter_fn,
+        mask=mask,
+        memory=memory,
+        memory_mask=memory_mask,
+        training=training)
+    outputs = layer_norm_fn(inputs)
+    if attention is not None:
+      attention = tf.cast(attention, tf.float32)
+    return outputs, new_cache, attention
 
-      inputs, layer_cache, attention = layer(
+  def _run_layers(self,
+                  inputs,
+                  domain,
+                  layer_fn,
+                  adapter_fn,
+                  mask=None,
+                  memory=None,
+                  memory_mask=None,
+                  cache=None,
+                  training=None):
+    """Runs the decoder layers, each followed by its domain adapter."""
+    # The adapters cannot be batched across layers (e.g. with a single einsum
+    # over stacked weights): the adapter output of layer i is part of the input
+    # of layer i + 1.
+    new_cache = [None] * len(self.layers)
+    attention = None
+    for i, (layer, multi_domain_layer) in enumerate(zip(self.layers,self.multi_domain_layers)):
+      inputs, layer_cache, attention = layer_fn(
+          layer,
           inputs,
           mask=mask,
           memory=memory,
           memory_mask=memory_mask,
           cache=cache[i] if cache is not None else None,
           training=training)
-      new_cache.append(layer_cache)
+      new_cache[i] = layer_cache
       if self.ADAP_layer_stopping_gradient:
-        inputs = multi_domain_layer(tf.stop_gradient(inputs), domain_mask) + inputs
+        inputs = adapter_fn(multi_domain_layer, tf.stop_gradient(inputs), domain, inputs)
       else:
-        inputs = multi_domain_layer(inputs, domain_mask) + inputs
-
-    outputs = self.layer_norm(inputs)
+        inputs = adapter_fn(multi_domain_layer, inputs, domain, inputs)
+    return inputs, tuple(new_cache), attention
+
+  def _run_step(self,
+                inputs,
+                timestep,
+                cache,
+                memory=None,
+                memory_mask=None,
+                training=None):
+    """Runs a single decoding step on inputs of shape :math:`[B, D]`.
+
+    Unlike :meth:`_run`, no query mask is built and the memory mask is
+    expected to be computed by the caller.
+    """
+    domain = inputs[1]
+    embed_prep = self._jit_embed_prep if self.jit_compile else self._embed_prep
+    inputs = embed_prep(tf.expand_dims(inputs[0], 1), position=timestep + 1, training=training)
+    inputs, new_cache, attention = self._run_layers(
+        inputs,
+        domain,
+        _call_layer,
+        _call_adapter,
+        memory=memory,
+        memory_mask=memory_mask,
+        cache=cache,
+        training=training)
+    outputs = tf.squeeze(self.layer_norm(inputs), axis=1)
+    if attention is not None:
+      attention = tf.cast(tf.squeeze(attention, axis=1), tf.float32)
     return outputs, new_cache, attention
 
   def forward(self,
@@ -160,8 +350,8 @@ class Multi_domain_SelfAttentionDecoder(Decoder):
     outputs, state, attention = self._run(
         inputs,
         sequence_length=sequence_length,
-        memory=memory,
-        memory_sequence_length=memory_sequence_length,
+        memory=_as_tuple(memory),
+        memory_sequence_length=_as_tuple(memory_sequence_length),
         training=training)
     logits = self.output_layer(outputs)
     return logits, state, attention
@@ -184,8 +374,8 @@ class Multi_domain_SelfAttentionDecoder(Decoder):
         inputs,
         args_dict,
         sequence_length=sequence_length,
-        memory=memory,
-        memory_sequence_length=memory_sequence_length,
+        memory=_as_tuple(memory),
+        memory_sequence_length=_as_tuple(memory_sequence_length),
         training=training)
     logits = self.output_layer.forward_fn(outputs, args_dict)
     return logits, state, attention
@@ -198,91 +388,130 @@ class Multi_domain_SelfAttentionDecoder(Decoder):
            memory_sequence_length=None,
            training=None):
     
-    inputs = [tf.expand_dims(inputs[0], 1), inputs[1]]
-    outputs, state, attention = self._run(
+    memory = _as_tuple(memory)
+    # The memory mask does not change across timesteps so it is computed once
+    # in the initial state when the memory is known at that time.
+    memory_mask = state.get("memory_mask")
+    if memory_mask is None:
+      memory_mask = self._memory_mask(memory, _as_tuple(memory_sequence_length))
+    outputs, cache, attention = self._run_step(
         inputs,
-        cache=state,
+        timestep,
+        state["layers"],
         memory=memory,
-        memory_sequence_length=memory_sequence_length,
-        step=timestep,
+        memory_mask=memory_mask,
         training=training)
-    outputs = tf.squeeze(outputs, axis=1)
-    if attention is not None:
-      attention = tf.squeeze(attention, axis=1)
+    state = dict(state, layers=cache)
     return outputs, state, attention
+
+  def _memory_mask(self, memory, memory_sequence_length):
+    """Builds the memory mask. :obj:`memory` and :obj:`memory_sequence_length`
+    are tuples with one entry per source (see :func:`_as_tuple`).
+    """
+    if memory_sequence_length is None:
+      return None
+    memory_mask = []
+    for mem, mem_length in zip(memory, memory_sequence_length):
+      memory_mask.append(self._sequence_mask(mem_length, shape_list(mem)[1]))
+    return memory_mask
     
   def _get_initial_state(self, batch_size, dtype, initial_state=None):
 
-    # The decoder state contains the keys and values projections of the previous timesteps.
+    # The decoder state contains the keys and values projections of the previous
+    # timesteps and the memory mask.
     _ = initial_state
+    dtype = self._body_dtype
     cache = []
     for _ in self.layers:
       shape = [batch_size, self.num_heads, 0, self.num_units // self.num_heads]
-      self_kv = (tf.zeros(shape, dtype=dtype), tf.zeros(shape, dtype=dtype))
+      self_shape = list(shape)
+      if self.cache_length is not None:
+        self_shape[2] = self.cache_length
+      if self.quantize_cache:
+        scale_shape = self_shape[:-1] + [1]
+        self_kv = tuple(
+            (tf.zeros(self_shape, dtype=tf.int8), tf.zeros(scale_shape, dtype=tf.float16))
+            for _ in range(2))
+      else:
+        self_kv = (tf.zeros(self_shape, dtype=dtype), tf.zeros(self_shape, dtype=dtype))
+      if self.cache_length is not None:
+        self_kv += (tf.constant(0),)
       memory_kv = [
           (tf.zeros(shape, dtype=dtype), tf.zeros(shape, dtype=dtype))
           for _ in range(self.num_sources)]
       cache.append(dict(self_kv=self_kv, memory_kv=memory_kv))
-    return cache
+    state = dict(layers=tuple(cache))
+    memory_mask = self._memory_mask(_as_tuple(self.memory), _as_tuple(self.memory_sequence_length))
+    if memory_mask is not None:
+      state["memory_mask"] = memory_mask
+    return state
+
+  def _grow_cache(self, state, maximum_iterations):
+    """Pads the preallocated self-attention caches of :obj:`state` so that they
+    can hold :obj:`maximum_iterations` decoding steps.
+    """
+    cache_length = _next_power_of_two(maximum_iterations)
+    cache = []
+    for layer_cache in state["layers"]:
+      self_kv = layer_cache["self_kv"]
+      if len(self_kv) == 3:
+        padding = cache_length - shape_list(tf.nest.flatten(self_kv[0])[0])[2]
+        if padding > 0:
+          self_kv = tf.nest.map_structure(
+              lambda x: tf.pad(x, [[0, 0], [0, 0], [0, padding], [0, 0]]),
+              tuple(self_kv[:2])) + tuple(self_kv[2:])
+      cache.append(dict(layer_cache, self_kv=self_kv))
+    return dict(state, layers=tuple(cache))
+
+  def dynamic_decode(self,
+                     embeddings,
+                     start_ids,
+                     end_id=constants.END_OF_SENTENCE_ID,
+                     initial_state=None,
+                     decoding_strategy=None,
+                     sampler=None,
+                     maximum_iterations=None,
+                     minimum_iterations=0):
+    if isinstance(embeddings, text_inputter.WordEmbedder):
+      input_fn = lambda ids: embeddings({"ids": ids})
+    elif callable(embeddings):
+      input_fn = embeddings
+    else:
+      input_fn = lambda ids: tf.nn.embedding_lookup(embeddings, ids)
+
+    # The preallocated cache is sized when the decoder is built, but the number of
+    # decoding iterations is only known here.
+    if initial_state is not None and isinstance(maximum_iterations, int):
+      initial_state = self._grow_cache(initial_state, maximum_iterations)
+
+    return decoding.dynamic_decode(
+        lambda ids, step, state: self(input_fn(ids), step, state),
+        start_ids,
+        end_id=end_id,
+        initial_state=initial_state,
+        decoding_strategy=decoding_strategy,
+        sampler=sampler,
+        maximum_iterations=maximum_iterations,
+        minimum_iterations=minimum_iterations,
+        attention_history=self.support_alignment_history,
+        attention_size=tf.shape(self.memory)[1] if self.support_alignment_history else None)
 
   def _run_forward_fn(self,
            inputs,
            args_dict,
            sequence_length=None,
-           cache=None,
            memory=None,
            memory_sequence_length=None,
-           step=None,
            training=None):
-    domain = inputs[1]
-    domain_mask = tf.nn.embedding_lookup(self.mask, domain)
-    inputs = inputs[0]
-    inputs *= self.num_units**0.5
-    if self.position_encoder is not None:
-      inputs = self.position_encoder(inputs, position=step + 1 if step is not None else None)
-    inputs = common.dropout(inputs, self.dropout, training=training)
-
-    # Prepare query mask.
-    mask = None
-    if step is None:
-      maximum_length = tf.shape(inputs)[1]
-      if sequence_length is None:
-        batch_size = tf.shape(inputs)[0]
-        sequence_length = tf.fill([batch_size], maximum_length)
-      mask = transformer.future_mask(sequence_length, maximum_length=maximum_length)
-
-    # Prepare memory mask.
-    memory_mask = None
-    if memory is not None:
-      if not isinstance(memory, (list, tuple)):
-        memory = (memory,)
-    if memory_sequence_length is not None:
-      if not isinstance(memory_sequence_length, (list, tuple)):
-        memory_sequence_length = (memory_sequence_length,)
-      memory_mask = [
-          tf.sequence_mask(mem_length, maxlen=tf.shape(mem)[1])
-          for mem, mem_length in zip(memory, memory_sequence_length)]
-    
-    # Run each layer.
-    new_cache = []
-    for i, (layer, multi_domain_layer) in enumerate(zip(self.layers,self.multi_domain_layers)):
-
-      inputs, layer_cache, attention = layer.forward_fn(
-          inputs,
-          args_dict,
-          mask=mask,          
-          memory=memory,
-          memory_mask=memory_mask,
-          cache=cache[i] if cache is not None else None,
-          training=training)
-      new_cache.append(layer_cache)
-      if self.ADAP_layer_stopping_gradient:
-        inputs = multi_domain_layer.forward_fn(tf.stop_gradient(inputs), args_dict, domain_mask) + inputs
-      else:
-        inputs = multi_domain_layer.forward_fn(inputs, args_dict, domain_mask) + inputs
-
-    outputs = self.layer_norm.forward_fn(inputs, args_dict)
-    return outputs, new_cache, attention
+    return self._run_core(
+        inputs,
+        lambda layer, inputs, **kwargs: layer.forward_fn(inputs, args_dict, **kwargs),
+        lambda layer, inputs, domain, residual: layer.forward_fn(inputs, args_dict, domain) + residual,
+        lambda inputs: self.layer_norm.forward_fn(inputs, args_dict),
+        sequence_length=sequence_length,
+        memory=memory,
+        memory_sequence_length=memory_sequence_length,
+        training=training)
 
 class Multi_domain_SelfAttentionDecoder_v1(Decoder):
   
@@ -50,13 +50,12 @@ class Multi_domain_SelfAttentionEncoder(Encoder):
             ffn_activation=ffn_activation)
         for i in range(num_layers)]
     self.multi_domain_layers = [
-        Multi_domain_FeedForwardNetwork(num_domains*num_domain_units, num_units, name="ADAP_%d"%i)
+        Multi_domain_FeedForwardNetwork(num_domains*num_domain_units, num_units, num_domains=num_domains, name="ADAP_%d"%i)
         for i in range(num_layers)]
     self.ADAP_layer_stopping_gradient = ADAP_layer_stopping_gradient
 
   def call(self, inputs, sequence_length=None, training=None):
     domain = inputs[1]
-    domain_mask = tf.nn.embedding_lookup(self.mask, domain)
     inputs = inputs[0]
     inputs *= self.num_units**0.5
     if self.position_encoder is not None:
@@ -67,15 +66,14 @@ class Multi_domain_SelfAttentionEncoder(Encoder):
     for layer, multi_domain_layer in zip(self.layers,self.multi_domain_layers):
       inputs = layer(inputs, mask=mask, training=training)
       if self.ADAP_layer_stopping_gradient:
-        inputs = multi_domain_layer(tf.stop_gradient(inputs), domain_mask, training=training) + inputs
+        inputs = multi_domain_layer(tf.stop_gradient(inputs), domain, training=training) + inputs
       else:
-        inputs = multi_domain_layer(inputs, domain_mask, training=training) + inputs
+        inputs = multi_domain_layer(inputs, domain, training=training) + inputs
     outputs = self.layer_norm(inputs)
     return outputs, None, sequence_length
 
   def forward_fn(self, inputs, args_dict, sequence_length=None, training=None):
     domain = inputs[1]
-    domain_mask = tf.nn.embedding_lookup(self.mask, domain)
     inputs = inputs[0]
     inputs *= self.num_units**0.5
     if self.position_encoder is not None:
@@ -86,9 +84,9 @@ class Multi_domain_SelfAttentionEncoder(Encoder):
     for layer, multi_domain_layer in zip(self.layers,self.multi_domain_layers):
       inputs = layer.forward_fn(inputs, args_dict, mask=mask, training=training)
       if self.ADAP_layer_stopping_gradient:
-        inputs = multi_domain_layer.forward_fn(tf.stop_gradient(inputs), args_dict, domain_mask, training=training) + inputs
+        inputs = multi_domain_layer.forward_fn(tf.stop_gradient(inputs), args_dict, domain, training=training) + inputs
       else:
-        inputs = multi_domain_layer.forward_fn(inputs, args_dict, domain_mask, training=training) + inputs
+        inputs = multi_domain_layer.forward_fn(inputs, args_dict, domain, training=training) + inputs
     outputs = self.layer_norm.forward_fn(inputs, args_dict)
     return outputs, None, sequence_length
     
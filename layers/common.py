@@ -89,11 +89,13 @@ class LayerNorm(tf.keras.layers.Layer):
     super(LayerNorm, self).build(input_shape)
 
   def call(self, x):  # pylint: disable=arguments-differ
-    """Normalizes :obj:`x`."""
+    """Normalizes :obj:`x`. The statistics are always computed in float32."""
+    dtype = x.dtype
+    x = tf.cast(x, tf.float32)
     mean = tf.reduce_mean(x, axis=[-1], keepdims=True)
     variance = tf.reduce_mean(tf.square(x - mean), axis=[-1], keepdims=True)
     norm_x = (x - mean) * tf.math.rsqrt(variance + self.epsilon)
-    return norm_x * self.gamma + self.beta
+    return tf.cast(norm_x, dtype) * self.gamma + self.beta
 
   def forward_fn(self, x, args_dict):  # pylint: disable=arguments-differ
     """Normalizes :obj:`x`."""
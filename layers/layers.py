@@ -65,38 +65,156 @@ class Multi_domain_FeedForwardNetwork(tf.keras.layers.Layer):
   def __init__(self,
                inner_dim,
                output_dim,
+               num_domains=1,
                dropout=0.1,
                activation=tf.nn.relu,
+               jit_compile=False,
                **kwargs):
     
     super(Multi_domain_FeedForwardNetwork, self).__init__(**kwargs)
+    if inner_dim % num_domains != 0:
+      raise ValueError("inner_dim should be a multiple of num_domains")
     self.inner = common.Dense(inner_dim, activation=activation)
     self.outer = common.Dense(output_dim)
+    self.num_domains = num_domains
+    self.num_domain_units = inner_dim // num_domains
     self.dropout = dropout
     self.layer_norm = common.LayerNorm()
+    # When set, the adapter runs as an XLA cluster. It is compiled again for each
+    # new input shape, which is costly with length bucketed batches.
+    self.jit_compile = jit_compile
 
-  def call(self, inputs, mask, training=None):  # pylint: disable=arguments-differ
-    """Runs the layer."""
-    inputs = self.layer_norm(inputs)
-    inner = self.inner(inputs)
-    inner = inner * tf.broadcast_to(tf.expand_dims(mask,1), tf.shape(inner))
+  def build(self, input_shape):
+    # Sublayers are built here rather than inside the compiled function so that
+    # their variables keep the usual scoped names.
+    inner_shape = tf.TensorShape(input_shape)[:-1].concatenate(self.inner.units)
+    for layer, shape in ((self.layer_norm, input_shape), (self.inner, input_shape), (self.outer, inner_shape)):
+      with tf.name_scope(layer.name):
+        layer.build(shape)
+    super(Multi_domain_FeedForwardNetwork, self).build(input_shape)
+
+  def _domain_ffn(self,
+                  inputs,
+                  domain,
+                  inner_kernel,
+                  inner_bias,
+                  outer_kernel,
+                  outer_bias,
+                  single_domain=False,
+                  training=None):
+    """Runs the FFN on the :obj:`num_domain_units` inner units of each example's domain.
+
+    The kernels are sliced per domain instead of masking the full inner
+    projection, so no work is spent on the units of the other domains. The
+    extra domain id :obj:`num_domains` has no units and only outputs the bias.
+
+    When :obj:`single_domain` is set, all examples share one domain and its
+    weight slice is applied as one dense matmul instead of being gathered for
+    each example (see :meth:`_dispatch`).
+    """
+    domain = tf.broadcast_to(domain, tf.shape(inputs)[:1])
+    valid = tf.cast(tf.less(domain, self.num_domains), inputs.dtype)
+    domain = tf.minimum(domain, self.num_domains - 1)
+    inner_kernel = tf.reshape(inner_kernel, [-1, self.num_domains, self.num_domain_units])
+    inner_bias = tf.reshape(inner_bias, [self.num_domains, self.num_domain_units])
+    outer_kernel = tf.reshape(outer_kernel, [self.num_domains, self.num_domain_units, -1])
+
+    if single_domain:
+      inner = tf.einsum("btd,du->btu", inputs, tf.gather(inner_kernel, domain[0], axis=1))
+    else:
+      inner = tf.einsum("btd,dbu->btu", inputs, tf.gather(inner_kernel, domain, axis=1))
+    inner = self.inner.activation(inner + tf.expand_dims(tf.gather(inner_bias, domain), 1))
+    inner = inner * valid[:, tf.newaxis, tf.newaxis]
     inner = common.dropout(inner, self.dropout, training=training)
-    outputs = self.outer(inner)
+    if single_domain:
+      outputs = tf.einsum("btu,ud->btd", inner, tf.gather(outer_kernel, domain[0]))
+    else:
+      outputs = tf.einsum("btu,bud->btd", inner, tf.gather(outer_kernel, domain))
+    return outputs + outer_bias
+
+  def _bias_outputs(self, inputs, outer_bias):
+    """Returns the outputs of a batch where no example has a domain: the bias."""
+    output_shape = tf.concat([tf.shape(inputs)[:-1], tf.shape(outer_bias)], 0)
+    return tf.broadcast_to(tf.cast(outer_bias, self.compute_dtype), output_shape)
+
+  def _dispatch(self, inputs, domain, ffn, skip):
+    """Returns ``ffn(single_domain)``, where :obj:`single_domain` is set when all
+    examples share one domain (common at inference and for the per-domain
+    training batches), or ``skip()`` when no example has a domain.
+
+    The conditions are evaluated here rather than in :meth:`_domain_ffn`:
+    differentiating a data-dependent ``tf.cond`` inside the XLA cluster of
+    :meth:`_jit_fused_call` emits ops that XLA cannot compile.
+    """
+    domain = tf.broadcast_to(domain, tf.shape(inputs)[:1])
+    single_domain = tf.equal(tf.reduce_min(domain), tf.reduce_max(domain))
+    branch = tf.where(
+        tf.reduce_any(tf.less(domain, self.num_domains)),
+        tf.where(single_domain, 1, 2),
+        0)
+    return tf.switch_case(branch, [skip, lambda: ffn(True), lambda: ffn(False)])
+
+  def _fused_call(self, inputs, domain, residual=None, single_domain=False, training=None):
+    """Runs the adapter and its residual connection."""
+    inputs = tf.cast(self.layer_norm(inputs), self.compute_dtype)
+    outputs = self._domain_ffn(
+        inputs,
+        domain,
+        self.inner.kernel,
+        self.inner.bias,
+        self.outer.kernel,
+        self.outer.bias,
+        single_domain=single_domain,
+        training=training)
+    if residual is None:
+      return outputs, outputs
+    # The adapter outputs are also returned for the regularization loss, so the
+    # sum needs its own buffer even when XLA fuses the add with the adapter.
+    # tf.raw_ops.InplaceAdd would not avoid it: it has no gradient and copies
+    # its input anyway when the tensor is still referenced.
+    return outputs, outputs + residual
+
+  # Same as _fused_call as a single XLA cluster, used when jit_compile is set.
+  _jit_fused_call = tf.function(_fused_call, jit_compile=True, experimental_relax_shapes=True)
+
+  def call(self, inputs, domain, residual=None, training=None):  # pylint: disable=arguments-differ
+    """Runs the layer. When :obj:`residual` is set, it is added to the adapter output."""
+    def _skip():
+      outputs = self._bias_outputs(inputs, self.outer.bias)
+      return outputs, outputs if residual is None else outputs + residual
+
+    fused_call = self._jit_fused_call if self.jit_compile else self._fused_call
+    outputs, fused_outputs = self._dispatch(
+        inputs,
+        domain,
+        lambda single_domain: fused_call(
+            inputs, domain, residual=residual, single_domain=single_domain, training=training),
+        _skip)
     self.add_loss(tf.reduce_mean(tf.reduce_sum(tf.abs(tf.reshape(outputs,[-1,tf.shape(outputs)[-1]])),axis=-1)))
     if not training:
       tf.print("#######")
       tf.print(self.name_scope(), "Inputs_max_abs_pooling: ", tf.reduce_max(tf.abs(inputs)), "ADAP_max_abs_pooling: ", 
                 tf.reduce_max(tf.abs(outputs)), "ADAP_min_abs_pooling: ", tf.reduce_min(tf.abs(outputs)), sep="|")
       tf.print("#######")
-    return outputs
+    return fused_outputs
 
-  def forward_fn(self, inputs, args_dict, mask, training=None):  # pylint: disable=arguments-differ
+  def forward_fn(self, inputs, args_dict, domain, training=None):  # pylint: disable=arguments-differ
     """Runs the layer."""
-    inputs = self.layer_norm(inputs)
-    inner = self.inner.forward_fn(inputs, args_dict)
-    inner = inner * tf.broadcast_to(tf.expand_dims(mask,1), tf.shape(inner))
-    inner = common.dropout(inner, self.dropout, training=training)
-    return self.outer.forward_fn(inner, args_dict)
+    outer_bias = args_dict[self.outer.bias.name]
+    normalized_inputs = self.layer_norm(inputs)
+    return self._dispatch(
+        inputs,
+        domain,
+        lambda single_domain: self._domain_ffn(
+            normalized_inputs,
+            domain,
+            args_dict[self.inner.kernel.name],
+            args_dict[self.inner.bias.name],
+            args_dict[self.outer.kernel.name],
+            outer_bias,
+            single_domain=single_domain,
+            training=training),
+        lambda: self._bias_outputs(inputs, outer_bias))
 
 class Multi_domain_FeedForwardNetwork_v2(tf.keras.layers.Layer):
 
@@ -56,6 +56,77 @@ def combine_heads(inputs):
   outputs = tf.reshape(outputs, [shape[0], shape[2], shape[1] * shape[3]])
   return outputs
 
+def _quantize(x):
+  """Quantizes :obj:`x` to int8 with one float16 scale per vector of the last
+  dimension (i.e. per timestep and head for attention keys and values).
+  """
+  x = tf.cast(x, tf.float32)
+  scale = tf.reduce_max(tf.abs(x), axis=-1, keepdims=True) / 127.0
+  scale = tf.maximum(scale, 1e-8)
+  quantized = tf.cast(tf.round(x / scale), tf.int8)
+  return quantized, tf.cast(scale, tf.float16)
+
+def _dequantize(quantized, scale, dtype):
+  return tf.cast(tf.cast(quantized, tf.float32) * tf.cast(scale, tf.float32), dtype)
+
+def _write_step_in_cache(cache, keys, values):
+  """Writes the keys and values of one timestep in a preallocated cache.
+
+  Args:
+    cache: A tuple ``(keys, values, position)`` where the keys and values have
+      shape :math:`[B, H, L, D]` and ``position`` is the timestep to write.
+    keys: The keys of the current timestep, with shape :math:`[B, H, 1, D]`.
+    values: The values of the current timestep, with shape :math:`[B, H, 1, D]`.
+
+  Returns:
+    The updated cache and a mask of shape :math:`[1, 1, L]` for the timesteps
+    written so far.
+  """
+  cache_kv, position = tuple(cache[:2]), cache[2]
+  shape = misc.shape_list(tf.nest.flatten(cache_kv)[0])
+  # Out of range updates are an error on CPU but are silently dropped on GPU.
+  position_check = tf.debugging.assert_less(
+      position,
+      shape[2],
+      message="The decoding step is past the end of the preallocated self-attention cache")
+  batch_index = tf.broadcast_to(tf.expand_dims(tf.range(shape[0]), 1), shape[:2])
+  head_index = tf.broadcast_to(tf.expand_dims(tf.range(shape[1]), 0), shape[:2])
+  with tf.control_dependencies([position_check]):
+    indices = tf.stack([batch_index, head_index, tf.fill(shape[:2], position)], axis=-1)
+  cache_kv = tf.nest.map_structure(
+      lambda c, x: tf.tensor_scatter_nd_update(c, indices, x[:, :, 0]),
+      cache_kv,
+      (keys, values))
+  mask = tf.reshape(tf.range(shape[2]) <= position, [1, 1, -1])
+  return cache_kv + (position + 1,), mask
+
+def _update_cache(cache, keys, values):
+  """Adds the keys and values of the current timestep to a self-attention cache.
+
+  The cache is either a tuple ``(keys, values)`` growing along time or a tuple
+  ``(keys, values, position)`` preallocated to the maximum length (see
+  :func:`_write_step_in_cache`). In both cases, the keys and values can be
+  stored as int8 tuples ``(quantized, scale)``.
+
+  Returns:
+    The updated cache, the keys and values to attend to, and the mask of the
+    cached timesteps (``None`` for a growing cache).
+  """
+  dtype = keys.dtype
+  quantized = isinstance(cache[0], tuple)
+  if quantized:
+    keys, values = _quantize(keys), _quantize(values)
+  if len(cache) == 3:
+    cache, mask = _write_step_in_cache(cache, keys, values)
+  else:
+    cache = tf.nest.map_structure(
+        lambda c, x: tf.concat([c, x], axis=2), tuple(cache), (keys, values))
+    mask = None
+  keys, values = cache[0], cache[1]
+  if quantized:
+    keys, values = _dequantize(*keys, dtype), _dequantize(*values, dtype)
+  return cache, keys, values, mask
+
 class FeedForwardNetwork(tf.keras.layers.Layer):
   
   def __init__(self,
@@ -152,8 +223,11 @@ class MultiHeadAttention(tf.keras.layers.Layer):
     if memory is None:
       keys, values = _compute_kv(inputs)
       if cache:
-        keys = tf.concat([cache[0], keys], axis=2)
-        values = tf.concat([cache[1], values], axis=2)
+        cache, keys, values, cache_mask = _update_cache(cache, keys, values)
+        if cache_mask is not None:
+          mask = cache_mask
+      else:
+        cache = (keys, values)
     else:
       if cache:
         keys, values = tf.cond(
@@ -162,8 +236,7 @@ class MultiHeadAttention(tf.keras.layers.Layer):
             false_fn=lambda: cache)
       else:
         keys, values = _compute_kv(memory)
-
-    cache = (keys, values)
+      cache = (keys, values)
 
     # Dot product attention.
     dot = tf.matmul(queries, keys, transpose_b=True)
@@ -201,8 +274,11 @@ class MultiHeadAttention(tf.keras.layers.Layer):
     if memory is None:
       keys, values = _compute_kv(inputs)
       if cache:
-        keys = tf.concat([cache[0], keys], axis=2)
-        values = tf.concat([cache[1], values], axis=2)
+        cache, keys, values, cache_mask = _update_cache(cache, keys, values)
+        if cache_mask is not None:
+          mask = cache_mask
+      else:
+        cache = (keys, values)
     else:
       if cache:
         keys, values = tf.cond(
@@ -211,8 +287,7 @@ class MultiHeadAttention(tf.keras.layers.Layer):
             false_fn=lambda: cache)
       else:
         keys, values = _compute_kv(memory)
-
-    cache = (keys, values)
+      cache = (keys, values)
 
     # Dot product attention.
     dot = tf.matmul(queries, keys, transpose_b=True)